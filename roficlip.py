@@ -30,30 +30,21 @@ Commands:
 
 """
 import errno
+import json
+import mmap
 import os
-import sys
 import stat
 import struct
+from collections import OrderedDict
 from subprocess import Popen, DEVNULL
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkstemp
 from html import escape
 
-try:
-    # https://docs.gtk.org/gtk3/method.Clipboard.clear.html
-    import gi
-    gi.require_version("Gtk", "3.0")
-    from gi.repository import Gtk, Gdk, GLib
-except ImportError:
-    raise
-
-import yaml
 from docopt import docopt
 from xdg import BaseDirectory
 
-try:
-    import notify2
-except ImportError:
-    pass
+# Gtk, yaml and notify2 are imported on demand, they are slow to load
+# and not needed for copying selected item.
 
 
 # Used for injecting hidden index for menu rows. Simulate dmenu behavior.
@@ -67,15 +58,22 @@ ROFI_COMMENT = '<span color="#aaa">#{}</span>'
 # Used with fifo as instruction for cleaing clipboard history
 CLEAR_CODE = b'\0clear'.decode('utf-8')
 
+# Database files start with magic, followed by records from oldest to newest.
+# Record header is big-endian length of the following item.
+# Files without magic are in legacy format: records from newest to oldest.
+_MAGIC = b'RCL\x01'
+_HDR = struct.Struct('>i')
+
 
 class ClipboardManager():
-    def __init__(self):
+    def __init__(self, lite=False):
         # Init databases and fifo
         name = 'roficlip'
         self.ring_db = '{0}/{1}'.format(BaseDirectory.save_data_path(name), 'ring.db')
         self.persist_db = '{0}/{1}'.format(BaseDirectory.save_data_path(name), 'persistent.db')
         self.fifo_path = '{0}/{1}.fifo'.format(BaseDirectory.get_runtime_dir(strict=False), name)
         self.config_path = '{0}/settings'.format(BaseDirectory.save_config_path(name))
+        self.config_cache = '{0}/settings.json'.format(BaseDirectory.save_cache_path(name))
         if not os.path.isfile(self.ring_db):
             open(self.ring_db, "a+").close()
         if not os.path.isfile(self.persist_db):
@@ -85,52 +83,164 @@ class ClipboardManager():
             not stat.S_ISFIFO(os.stat(self.fifo_path).st_mode)
         ):
             os.mkfifo(self.fifo_path)
-        self.fifo = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
-
-        # Init clipboard and read databases
-        self.cb = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
-        self.ring = self.read(self.ring_db)
-        self.persist = self.read(self.persist_db)
+        # Databases are read on first access
+        self._ring = None
+        self._persist = None
+        # Pending ring changes, written to database on idle
+        self.ring_pending = []
+        self.ring_dirty = False
+        self.ring_scheduled = False
+        self.cb_stamp = None
+        if lite:
+            # Databases and fifo are enough for copying items
+            return
 
         # Load settings
         self.load_config()
 
+        # Init clipboard
+        # https://docs.gtk.org/gtk3/method.Clipboard.clear.html
+        import gi
+        gi.require_version("Gtk", "3.0")
+        from gi.repository import Gtk, Gdk
+        self.cb = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+
         # Init notifications
-        if self.cfg['notify'] and 'notify2' in sys.modules:
-            self.notify = notify2
-            self.notify.init(name)
-        else:
-            self.cfg['notify'] = False
+        if self.cfg['notify']:
+            try:
+                import notify2
+            except ImportError:
+                self.cfg['notify'] = False
+            else:
+                self.notify = notify2
+                self.notify.init(name)
+
+    @property
+    def ring(self):
+        """
+        Clipboard history items.
+        """
+        if self._ring is None:
+            self._ring = self.read(self.ring_db)
+            self.trim_ring()
+        return self._ring
+
+    @ring.setter
+    def ring(self, items):
+        self._ring = items
+
+    def ring_previews(self):
+        """
+        Previews of clipboard history items, enough for showing in rofi.
+        """
+        # Comments are at the end of clip, so cut clips would lose them
+        width = 0 if self.cfg['colored_comments'] else self.cfg['preview_width']
+        previews = self.read_previews(self.ring_db, width)
+        return previews[:self.cfg['ring_size']]
+
+    @property
+    def persist(self):
+        """
+        Persistent storage items.
+        """
+        if self._persist is None:
+            self._persist = self.read(self.persist_db)
+        return self._persist
+
+    @persist.setter
+    def persist(self, items):
+        self._persist = items
 
     def daemon(self):
         """
         Clipboard Manager daemon.
         """
-        GLib.timeout_add(300, self.cb_watcher)
-        GLib.timeout_add(300, self.fifo_watcher)
+        from gi.repository import Gtk
+        # Compact ring database, so it matches ring in memory.
+        # This also migrates legacy ring database.
+        self.write(self.ring_db, self.ring)
+        self.migrate(self.persist_db)
+        self.cb.connect('owner-change', self.cb_watcher)
+        self.watch_fifo()
+        # Pick up clipboard contents owned before daemon start
+        self.cb_watcher(self.cb, None)
         Gtk.main()
 
-    def cb_watcher(self):
+    def cb_watcher(self, clipboard, event):
         """
         Callback function.
-        Watch clipboard and write changes to ring database.
-        Must return "True" for continuous operation.
+        Called on clipboard owner change and save changes to ring database.
         """
-        clip = self.cb.wait_for_text()
+        if event is not None and event.selection_time:
+            # Selection re-announced by the same owner, skip costly text request
+            stamp = (event.owner, event.selection_time)
+            if stamp == self.cb_stamp:
+                return
+            self.cb_stamp = stamp
+        clip = clipboard.wait_for_text()
+        new = clip not in self.ring
         if self.sync_items(clip, self.ring):
-            self.ring = self.ring[0:self.cfg['ring_size']]
+            # Old clips stay in database until it grows twice of ring size
+            if new and len(self.ring) <= self.cfg['ring_size'] * 2:
+                self.save_ring(self.ring[clip])
+            else:
+                self.save_ring()
+
+    def save_ring(self, item=None):
+        """
+        Schedule ring database update, so burst of changes is written at once.
+        Encoded item is appended to database, otherwise database is rewritten.
+        """
+        if item is None:
+            self.ring_dirty = True
+        else:
+            self.ring_pending.append(item)
+        if not self.ring_scheduled:
+            from gi.repository import GLib
+            self.ring_scheduled = True
+            GLib.idle_add(self.flush_ring)
+
+    def flush_ring(self):
+        """
+        Callback function.
+        Write pending changes to ring database.
+        Must return "False" to run only once.
+        """
+        if self.ring_dirty:
+            self.trim_ring()
             self.write(self.ring_db, self.ring)
-        return True
+        else:
+            self.append(self.ring_db, self.ring_pending)
+        self.ring_pending = []
+        self.ring_dirty = False
+        self.ring_scheduled = False
+        return False
 
-    def fifo_watcher(self):
+    def trim_ring(self):
+        """
+        Drop oldest clips exceeding ring size.
+        """
+        while len(self.ring) > self.cfg['ring_size']:
+            self.ring.popitem()
+
+    def watch_fifo(self):
+        """
+        Open fifo for reading and watch it for incoming data.
+        """
+        from gi.repository import GLib
+        self.fifo = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        GLib.io_add_watch(self.fifo, GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP, self.fifo_watcher)
+
+    def fifo_watcher(self, fd, condition):
         """
         Callback function.
-        Copy contents from fifo to clipboard.
+        Called when fifo is ready. Copy contents from fifo to clipboard.
         Can clear clipboard history by instruction.
-        Must return "True" for continuous operation.
+        Must return "True" to keep watching fifo.
         """
+        from gi.repository import GLib
         try:
-            fifo_in = os.read(self.fifo, 65536)
+            fifo_in = os.read(fd, 65536)
         except OSError as err:
             if err.errno == errno.EAGAIN or err.errno == errno.EWOULDBLOCK:
                 fifo_in = None
@@ -139,23 +249,30 @@ class ClipboardManager():
         if fifo_in:
             if fifo_in.decode('utf-8') == CLEAR_CODE:
                 self.cb.set_text('', -1)
-                self.ring = ['']
-                self.write(self.ring_db, self.ring)
+                self.ring = OrderedDict([('', b'')])
+                self.save_ring()
                 self.notify_send('Clipboard is cleaned')
             else:
                 self.cb.set_text(fifo_in.decode('utf-8'), -1)
                 self.notify_send('Copied to the clipboard')
+        elif condition & GLib.IO_HUP:
+            # Writer has gone. Reopen fifo, otherwise hangup is reported forever
+            os.close(fd)
+            self.watch_fifo()
+            return False
         return True
 
     def sync_items(self, clip, items):
         """
         Sync clipboard contents with specified items dict when needed.
+        Existing clip is moved to the top instead of being duplicated.
+        Items dict maps clips to their utf-8 encoded form.
         Return "True" if dict modified, otherwise "False".
         """
-        if clip and (not items or clip != items[0]):
-            if clip in items:
-                items.remove(clip)
-            items.insert(0, clip)
+        if clip and (not items or clip != next(iter(items))):
+            if clip not in items:
+                items[clip] = clip.encode('utf-8')
+            items.move_to_end(clip, last=False)
             return True
         return False
 
@@ -163,42 +280,52 @@ class ClipboardManager():
         """
         Write to fifo instruction for cleaning clipboard history
         """
-        with open(self.fifo_path, "w") as file:
-            file.write(CLEAR_CODE)
-            file.close()
+        self.fifo_write(CLEAR_CODE.encode('utf-8'))
 
-    def copy_item(self, index, items):
+    def copy_item(self, index, fd):
         """
         Writes to fifo item that should be copied to clipboard.
         """
-        with open(self.fifo_path, "w") as file:
-            file.write(items[index])
-            file.close()
+        self.fifo_write(self.read_nth(fd, index))
+
+    def fifo_write(self, data):
+        """
+        Helper function. Write bytes to fifo.
+        """
+        fifo = os.open(self.fifo_path, os.O_WRONLY)
+        try:
+            os.write(fifo, data)
+        finally:
+            os.close(fifo)
 
     def show_items(self, items):
         """
         Format and show contents of specified items dict (for rofi).
         """
         print(ROFI_MARKUP) if self.cfg['colored_comments'] else None
-        for index, clip in enumerate(items):
-            if args['--actions']:
+        if args['--actions']:
+            for clip in items:
                 print(clip)
-            else:
-                # Replace newline characters for joining string
-                clip = clip.replace('\n', self.cfg['newline_char'])
-                if (self.cfg['colored_comments'] or self.cfg['show_comments_first']) and '#' in clip:
-                    # Save index of last '#'
-                    idx = clip.rfind('#')
-                    body = escape(clip[:idx]) if self.cfg['colored_comments'] else clip[:idx]
-                    comment = ROFI_COMMENT.format(
-                        escape(clip[idx+1:])
-                    ) if self.cfg['colored_comments'] else '#' + clip[idx+1:]
-                    if args['--persistent'] and self.cfg['show_comments_first']:
-                        # Move text after last '#' to beginning of string
-                        clip = '{} {}'.format(comment, body)
-                    else:
-                        clip = '{} {}'.format(body, comment)
-                print('{}{}{}'.format(clip, ROFI_INFO, index))
+            return
+        # Settings are the same for every row
+        newline_char = self.cfg['newline_char']
+        colored = self.cfg['colored_comments']
+        comments = colored or self.cfg['show_comments_first']
+        comments_first = args['--persistent'] and self.cfg['show_comments_first']
+        for index, clip in enumerate(items):
+            # Replace newline characters for joining string
+            clip = clip.replace('\n', newline_char)
+            if comments and '#' in clip:
+                # Save index of last '#'
+                idx = clip.rfind('#')
+                body = escape(clip[:idx]) if colored else clip[:idx]
+                comment = ROFI_COMMENT.format(escape(clip[idx+1:])) if colored else '#' + clip[idx+1:]
+                if comments_first:
+                    # Move text after last '#' to beginning of string
+                    clip = '{} {}'.format(comment, body)
+                else:
+                    clip = '{} {}'.format(body, comment)
+            print('{}{}{}'.format(clip, ROFI_INFO, index))
 
     def persistent_add(self):
         """
@@ -215,7 +342,7 @@ class ClipboardManager():
         """
         clip = self.cb.wait_for_text()
         if clip and clip in self.persist:
-            self.persist.remove(clip)
+            del self.persist[clip]
             self.write(self.persist_db, self.persist)
             self.notify_send('Removed from persistent')
 
@@ -241,11 +368,11 @@ class ClipboardManager():
                     tmp.seek(0, 0)
                     clips = tmp.read().splitlines()
                     if clips:
-                        self.persist = []
+                        self.persist = OrderedDict()
                         for clip in clips:
                             clip = clip.replace('\n', '')
                             clip = clip.replace(self.cfg['newline_char'], '\n')
-                            self.persist.append(clip)
+                            self.persist[clip] = clip.encode('utf-8')
                         self.write(self.persist_db, self.persist)
             finally:
                 tmp.close()
@@ -275,26 +402,131 @@ class ClipboardManager():
     def read(self, fd):
         """
         Helper function. Binary reader.
+        Return ordered dict of items mapped to their utf-8 encoded form.
+        """
+        result = []
+        with open(fd, "rb") as file:
+            # Empty file can not be mapped
+            if not os.fstat(file.fileno()).st_size:
+                return OrderedDict()
+            # Parse records straight from page cache
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                legacy = data[:len(_MAGIC)] != _MAGIC
+                offset = 0 if legacy else len(_MAGIC)
+                while offset < len(data):
+                    chunksize = _HDR.unpack_from(data, offset)[0]
+                    offset += _HDR.size
+                    item = data[offset:offset + chunksize]
+                    result.append((item.decode('utf-8'), item))
+                    offset += chunksize
+        if not legacy:
+            result.reverse()
+        return OrderedDict(result)
+
+    def migrate(self, fd):
+        """
+        Rewrite legacy database in current format.
+        Legacy database may hold duplicates, after rewriting records on disk
+        match items and can be addressed by index.
+        """
+        with open(fd, "rb") as file:
+            header = file.read(len(_MAGIC))
+        if header and header != _MAGIC:
+            self.write(fd, self.read(fd))
+
+    def read_previews(self, fd, width):
+        """
+        Helper function. Binary reader.
+        Return list of items cut to width, skipping the rest of each record.
         """
         result = []
         with open(fd, "rb") as file:
-            bytes_read = file.read(4)
-            while bytes_read:
-                chunksize = struct.unpack('>i', bytes_read)[0]
-                bytes_read = file.read(chunksize)
-                result.append(bytes_read.decode('utf-8'))
-                bytes_read = file.read(4)
+            legacy = file.read(len(_MAGIC)) != _MAGIC
+            if legacy:
+                file.seek(0)
+            header = file.read(_HDR.size)
+            while header:
+                chunksize = _HDR.unpack(header)[0]
+                # Up to 4 bytes per character in utf-8
+                size = min(chunksize, width * 4) if width else chunksize
+                chunk = file.read(size)
+                if size < chunksize:
+                    file.seek(chunksize - size, os.SEEK_CUR)
+                    # Drop character possibly cut in the middle
+                    result.append(chunk.decode('utf-8', 'ignore')[:width])
+                else:
+                    result.append(chunk.decode('utf-8')[:width or None])
+                header = file.read(_HDR.size)
+        if not legacy:
+            result.reverse()
         return result
 
+    def read_nth(self, fd, index):
+        """
+        Helper function. Binary reader.
+        Return encoded item by index, reading only headers of other records.
+        """
+        records = []
+        with open(fd, "rb") as file:
+            legacy = file.read(len(_MAGIC)) != _MAGIC
+            if legacy:
+                file.seek(0)
+            header = file.read(_HDR.size)
+            while header:
+                chunksize = _HDR.unpack(header)[0]
+                records.append((file.tell(), chunksize))
+                file.seek(chunksize, os.SEEK_CUR)
+                header = file.read(_HDR.size)
+            offset, chunksize = records[index] if legacy else records[-1 - index]
+            file.seek(offset)
+            return file.read(chunksize)
+
     def write(self, fd, items):
         """
         Helper function. Binary writer.
         """
-        with open(fd, 'wb') as file:
-            for item in items:
-                item = item.encode('utf-8')
-                file.write(struct.pack('>i', len(item)))
-                file.write(item)
+        # Preallocate buffer for all records and fill it in place
+        buf = bytearray(len(_MAGIC) + sum(_HDR.size + len(item) for item in items.values()))
+        buf[:len(_MAGIC)] = _MAGIC
+        offset = len(_MAGIC)
+        for item in reversed(items.values()):
+            _HDR.pack_into(buf, offset, len(item))
+            offset += _HDR.size
+            buf[offset:offset + len(item)] = item
+            offset += len(item)
+        # Write to temporary file and replace database with it, so readers
+        # keep their mapping of old file and failed write keeps old contents.
+        # Symlinked database is replaced at its target.
+        fd = os.path.realpath(fd)
+        file, tmp = mkstemp(dir=os.path.dirname(fd), prefix='.', suffix='.tmp')
+        try:
+            # Keep mode of existing database, new one stays private
+            if os.path.exists(fd):
+                os.fchmod(file, stat.S_IMODE(os.stat(fd).st_mode))
+            # Pass whole buffer to kernel at once, bypassing io buffering
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(file, view):]
+            os.close(file)
+            file = None
+            os.replace(tmp, fd)
+        except BaseException:
+            if file is not None:
+                os.close(file)
+            os.unlink(tmp)
+            raise
+
+    def append(self, fd, items):
+        """
+        Helper function. Binary writer.
+        Append encoded items as newest records.
+        """
+        buf = bytearray()
+        for item in items:
+            buf += _HDR.pack(len(item))
+            buf += item
+        with open(fd, 'ab') as file:
+            file.write(buf)
 
     def load_config(self):
         """
@@ -304,6 +536,7 @@ class ClipboardManager():
         settings = {
             'settings': {
                 'ring_size': 20,
+                'preview_width': 200,
                 'newline_char': '¬',
                 'notify': True,
                 'notify_timeout': 1,
@@ -313,18 +546,67 @@ class ClipboardManager():
             'actions': {}
         }
         if os.path.isfile(self.config_path):
-            with open(self.config_path, "r") as file:
-                config = yaml.safe_load(file)
-                for key in {'settings', 'actions'}:
-                    if key in config:
-                        settings[key].update(config[key])
+            config = self.read_config()
+            for key in {'settings', 'actions'}:
+                if key in config:
+                    settings[key].update(config[key])
         self.cfg = settings['settings']
         self.actions = settings['actions']
 
+    def read_config(self):
+        """
+        Helper function. Config reader.
+        Parsed config is cached as json along with stat of yaml config,
+        and used while yaml config stays the same file.
+        """
+        st = os.stat(self.config_path)
+        signature = [st.st_mtime_ns, st.st_size, st.st_ino]
+        if os.path.isfile(self.config_cache):
+            try:
+                with open(self.config_cache, "r") as file:
+                    cache = json.load(file)
+            except ValueError:
+                # Broken cache, parse yaml config again
+                cache = None
+            if isinstance(cache, dict) and cache.get('stat') == signature:
+                return cache['config']
+        import yaml
+        with open(self.config_path, "r") as file:
+            # Prefer libyaml based loader when available
+            config = yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        try:
+            data = json.dumps({'stat': signature, 'config': config})
+        except (TypeError, ValueError):
+            # Config has values not representable in json, do not cache it
+            return config
+        # Replace cache at once, so concurrent runs never see it partly written
+        file, tmp = mkstemp(dir=os.path.dirname(self.config_cache), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(file, "w") as file:
+                file.write(data)
+            os.replace(tmp, self.config_cache)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return config
+
 
 if __name__ == "__main__":
-    cm = ClipboardManager()
     args = docopt(__doc__, version='0.5')
+    # Parse variables passed from rofi. See rofi-script.5 for details.
+    # We get index from selected row here.
+    if not args['--show']:
+        index = None
+    elif os.getenv('ROFI_INFO') is not None:
+        index = int(os.getenv('ROFI_INFO'))
+    else:
+        index = args['<item>']
+    if args['--show'] and index is not None and not args['--actions']:
+        # Copy item selected on second run without loading clipboard and settings
+        cm = ClipboardManager(lite=True)
+        cm.copy_item(index, cm.persist_db if args['--persistent'] else cm.ring_db)
+        exit(0)
+    cm = ClipboardManager()
     if args['--quiet']:
         cm.cfg['notify'] = False
     if args['--daemon']:
@@ -338,21 +620,10 @@ if __name__ == "__main__":
     elif args['--edit']:
         cm.persistent_edit()
     elif args['--show']:
-        # Parse variables passed from rofi. See rofi-script.5 for details.
-        # We get index from selected row here.
-        if os.getenv('ROFI_INFO') is not None:
-            index = int(os.getenv('ROFI_INFO'))
-        elif args['<item>'] is not None:
-            index = args['<item>']
-        else:
-            index = None
         # Show contents on first run
         if index is None:
-            cm.show_items(cm.actions if args['--actions'] else cm.persist if args['--persistent'] else cm.ring)
+            cm.show_items(cm.actions if args['--actions'] else cm.persist if args['--persistent'] else cm.ring_previews())
         # Do actions on second run
         else:
-            if args['--actions']:
-                cm.do_action(index)
-            else:
-                cm.copy_item(index, cm.persist if args['--persistent'] else cm.ring)
+            cm.do_action(index)
     exit(0)
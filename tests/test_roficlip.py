@@ -0,0 +1,221 @@
+import json
+import os
+import stat
+import struct
+import sys
+import types
+from collections import OrderedDict
+
+import pytest
+from xdg import BaseDirectory
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from roficlip import ClipboardManager  # noqa: E402
+
+
+@pytest.fixture
+def cm(tmp_path, monkeypatch):
+    """
+    Clipboard manager with databases, fifo and config placed in tmp_path.
+    """
+    for name in ('data', 'config', 'cache'):
+        monkeypatch.setattr(BaseDirectory, 'xdg_{}_home'.format(name), str(tmp_path / name))
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    cm = ClipboardManager(lite=True)
+    cm.load_config()
+    return cm
+
+
+@pytest.fixture
+def idle(monkeypatch):
+    """
+    Callbacks scheduled with GLib.idle_add. Call run_idle() to run them.
+    """
+    callbacks = []
+    repository = types.ModuleType('gi.repository')
+    repository.GLib = types.SimpleNamespace(idle_add=callbacks.append)
+    gi = types.ModuleType('gi')
+    gi.repository = repository
+    monkeypatch.setitem(sys.modules, 'gi', gi)
+    monkeypatch.setitem(sys.modules, 'gi.repository', repository)
+    return callbacks
+
+
+def run_idle(callbacks):
+    while callbacks:
+        callbacks.pop(0)()
+
+
+class Clipboard():
+    def __init__(self, text):
+        self.text = text
+
+    def wait_for_text(self):
+        return self.text
+
+
+def copy(cm, text):
+    cm.cb_watcher(Clipboard(text), None)
+
+
+def legacy_db(path, items):
+    with open(path, 'wb') as file:
+        for item in items:
+            item = item.encode('utf-8')
+            file.write(struct.pack('>i', len(item)) + item)
+
+
+def test_persistent_legacy_duplicates(cm):
+    legacy_db(cm.persist_db, ['a', '', 'b', '', 'c'])
+    with open(cm.persist_db, 'rb') as file:
+        legacy = file.read()
+    # Reading does not touch database
+    assert list(cm.read(cm.persist_db)) == ['a', '', 'b', 'c']
+    with open(cm.persist_db, 'rb') as file:
+        assert file.read() == legacy
+    cm.migrate(cm.persist_db)
+    menu = list(cm.persist)
+    assert menu == ['a', '', 'b', 'c']
+    # Selected menu row must copy the same item
+    assert [cm.read_nth(cm.persist_db, index) for index in range(len(menu))] == [item.encode('utf-8') for item in menu]
+
+
+def write_config(cm, text, mtime):
+    with open(cm.config_path, 'w') as file:
+        file.write(text)
+    os.utime(cm.config_path, (mtime, mtime))
+
+
+def test_broken_config_cache(cm):
+    pytest.importorskip('yaml')
+    write_config(cm, 'settings:\n  ring_size: 5\n', 0)
+    # Partly written cache
+    with open(cm.config_cache, 'w') as file:
+        file.write('{"stat": [0, 24, ')
+    cm.load_config()
+    assert cm.cfg['ring_size'] == 5
+    with open(cm.config_cache) as file:
+        assert json.load(file)['config'] == {'settings': {'ring_size': 5}}
+    assert os.listdir(os.path.dirname(cm.config_cache)) == ['settings.json']
+    # Cache is used while config stays the same
+    cm.load_config()
+    assert cm.cfg['ring_size'] == 5
+
+
+def test_config_replaced_with_older_file(cm, tmp_path):
+    pytest.importorskip('yaml')
+    write_config(cm, 'settings:\n  ring_size: 5\n', 1000)
+    cm.load_config()
+    assert cm.cfg['ring_size'] == 5
+    # Restored config with older mtime must not be shadowed by cache
+    backup = str(tmp_path / 'backup')
+    with open(backup, 'w') as file:
+        file.write('settings:\n  ring_size: 50\n')
+    os.utime(backup, (0, 0))
+    os.replace(backup, cm.config_path)
+    cm.load_config()
+    assert cm.cfg['ring_size'] == 50
+
+
+def test_ring_previews_keep_comments(cm):
+    cm.cfg['preview_width'] = 3
+    legacy_db(cm.ring_db, ['text #comment'])
+    assert cm.ring_previews() == ['tex']
+    cm.cfg['colored_comments'] = True
+    assert cm.ring_previews() == ['text #comment']
+
+
+def test_ring_writes_coalesced(cm, idle):
+    cm.write(cm.ring_db, cm.ring)
+    for text in ('a', 'b', 'c'):
+        copy(cm, text)
+    # Burst of changes is written once, on idle
+    assert len(idle) == 1
+    assert list(cm.read(cm.ring_db)) == []
+    run_idle(idle)
+    assert list(cm.read(cm.ring_db)) == ['c', 'b', 'a']
+    # Moving clip to the top rewrites database, pending appends included
+    copy(cm, 'd')
+    copy(cm, 'a')
+    run_idle(idle)
+    assert list(cm.read(cm.ring_db)) == ['a', 'd', 'c', 'b']
+    assert not cm.ring_pending and not cm.ring_dirty and not cm.ring_scheduled
+
+
+def encoded(items):
+    return OrderedDict((item, item.encode('utf-8')) for item in items)
+
+
+def test_database_round_trip(cm):
+    cm.write(cm.ring_db, encoded(['b', 'a']))
+    cm.append(cm.ring_db, [b'c', 'dé'.encode('utf-8')])
+    with open(cm.ring_db, 'rb') as file:
+        data = file.read()
+    # Magic, then records from oldest to newest
+    assert data == b'RCL\x01' + b''.join(
+        struct.pack('>i', len(item)) + item for item in [b'a', b'b', b'c', 'dé'.encode('utf-8')]
+    )
+    assert list(cm.read(cm.ring_db)) == ['dé', 'c', 'b', 'a']
+
+
+def test_database_legacy_and_magic_read_same(cm):
+    legacy_db(cm.persist_db, ['c', 'b', 'a'])
+    cm.write(cm.ring_db, encoded(['c', 'b', 'a']))
+    assert cm.read(cm.persist_db) == cm.read(cm.ring_db) == encoded(['c', 'b', 'a'])
+    cm.migrate(cm.persist_db)
+    with open(cm.persist_db, 'rb') as file, open(cm.ring_db, 'rb') as other:
+        assert file.read() == other.read()
+
+
+def test_ring_append_switches_to_rewrite(cm, idle):
+    cm.cfg['ring_size'] = 2
+    cm.write(cm.ring_db, cm.ring)
+    inode = os.stat(cm.ring_db).st_ino
+    # New clips are appended until database holds twice of ring size
+    for text in ('a', 'b', 'c', 'd'):
+        copy(cm, text)
+        run_idle(idle)
+        assert os.stat(cm.ring_db).st_ino == inode
+    assert list(cm.read(cm.ring_db)) == ['d', 'c', 'b', 'a']
+    # Next one compacts database down to ring size
+    copy(cm, 'e')
+    run_idle(idle)
+    assert os.stat(cm.ring_db).st_ino != inode
+    assert list(cm.read(cm.ring_db)) == list(cm.ring) == ['e', 'd']
+
+
+def test_read_previews_order_and_width(cm):
+    items = ['long text', 'bébé', 'a']
+    legacy_db(cm.persist_db, items)
+    cm.write(cm.ring_db, encoded(['bébé', 'a']))
+    cm.append(cm.ring_db, [b'long text'])
+    for db in (cm.persist_db, cm.ring_db):
+        assert cm.read_previews(db, 0) == list(cm.read(db)) == items
+        assert cm.read_previews(db, 3) == ['lon', 'béb', 'a']
+
+
+def test_read_nth_matches_read(cm):
+    items = ['c', 'bé', 'a']
+    legacy_db(cm.persist_db, items)
+    cm.write(cm.ring_db, encoded(['bé', 'a']))
+    cm.append(cm.ring_db, [b'c'])
+    for db in (cm.persist_db, cm.ring_db):
+        assert [cm.read_nth(db, index) for index in range(len(items))] == list(cm.read(db).values())
+        with pytest.raises(IndexError):
+            cm.read_nth(db, len(items))
+
+
+def test_write_keeps_mode_and_symlink(cm, tmp_path):
+    os.chmod(cm.ring_db, 0o640)
+    cm.write(cm.ring_db, encoded(['a']))
+    assert stat.S_IMODE(os.stat(cm.ring_db).st_mode) == 0o640
+    # New database stays private
+    db = str(tmp_path / 'new.db')
+    cm.write(db, encoded(['a']))
+    assert stat.S_IMODE(os.stat(db).st_mode) == 0o600
+    # Symlinked database is replaced at its target
+    os.symlink(db, cm.persist_db + '.link')
+    cm.write(cm.persist_db + '.link', encoded(['b']))
+    assert os.path.islink(cm.persist_db + '.link')
+    assert list(cm.read(db)) == ['b']